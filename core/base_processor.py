@@ -6,7 +6,9 @@ class ImageProcessor(ABC):
     @abstractmethod
     def clone(self): pass
     @abstractmethod
-    def erase_by_mask(self, mask_path): pass
+    def erase_by_mask(self, mask_path, left, top): pass
+    @abstractmethod
+    def check_mask_size(self, mask_path): pass
     @abstractmethod
     def resize(self, width, height): pass
     @abstractmethod
@@ -16,6 +18,6 @@ class ImageProcessor(ABC):
     @abstractmethod
     def composite(self, other, x, y): pass
     @abstractmethod
-    def save(self, path, preview): pass
+    def save(self, path, preview, compression): pass
     @abstractmethod
     def load_layout(self, path): pass
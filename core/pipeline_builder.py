@@ -5,18 +5,26 @@ class ActionCommand:
     def __init__(self, action_type: str, params: Any):
         self.action_type = action_type
         self.params = params
+        self._bound_fn = None
+        self._use_kwargs = isinstance(params, dict)
 
-    def execute(self, processor):
-        if not hasattr(processor, self.action_type):
+    def bind(self, processor_class) -> 'ActionCommand':
+        # Kiểm tra action và lấy method một lần theo class; pipeline được cache theo
+        # (asset_dir, ProcessorClass) nên các row sau dùng lại command đã bind
+        if not hasattr(processor_class, self.action_type):
             raise AttributeError(f"Processor has no action '{self.action_type}'")
-        method = getattr(processor, self.action_type)
+        self._bound_fn = getattr(processor_class, self.action_type)
+        return self
+
+    def execute(self, processor):
+        if self._bound_fn is None:
+            self.bind(type(processor))
 
         # Nếu params là dict → dùng **kwargs
-        if isinstance(self.params, dict):
-            return method(**self.params)
+        if self._use_kwargs:
+            return self._bound_fn(processor, **self.params)
         # Nếu params là 1 giá trị đơn (int, str) → truyền trực tiếp
-        else:
-            return method(self.params)
+        return self._bound_fn(processor, self.params)
 
 
 class PartialPipeline:
@@ -29,7 +37,7 @@ class PartialPipeline:
         self.location = location
 
     @classmethod
-    def from_json(cls, partial_json: Dict, asset_dir: str = "") -> 'PartialPipeline':
+    def from_json(cls, partial_json: Dict, asset_dir: str = "", processor_class=None) -> 'PartialPipeline':
         steps = []
         for step in partial_json.get("steps", []):
             action = step.get("action")
@@ -39,5 +47,40 @@ class PartialPipeline:
                 data = os.path.join(asset_dir, data)
 
             steps.append(ActionCommand(action, data))
+        steps = cls.crop_before_mask(steps)
+        if processor_class is not None:
+            steps = [step.bind(processor_class) for step in steps]
         location = partial_json.get("location", {"top":0, "left":0})
         return cls(partial_json.get("id"), steps, location)
+
+    @staticmethod
+    def crop_before_mask(steps: List[ActionCommand]) -> List[ActionCommand]:
+        """
+        mask -> crop (crop cố định) cho kết quả giống crop -> mask với mask lấy đúng vùng crop.
+        Đưa crop lên trước để mask chỉ xử lý vùng đã crop thay vì cả ảnh input.
+        Tại vị trí gốc của mask thêm bước check_mask_size để vẫn báo lỗi khi mask lệch kích thước ảnh.
+        """
+        steps = list(steps)
+        changed = True
+        while changed:
+            changed = False
+            for i in range(len(steps) - 1):
+                mask, crop = steps[i], steps[i + 1]
+                if mask.action_type != 'erase_by_mask' or crop.action_type != 'crop' or crop.params.get('auto'):
+                    continue
+                moved = isinstance(mask.params, dict)
+                params = mask.params if moved else {'mask_path': mask.params}
+                params = {
+                    'mask_path': params['mask_path'],
+                    'left': params.get('left', 0) + crop.params.get('left', 0),
+                    'top': params.get('top', 0) + crop.params.get('top', 0),
+                }
+                replacement = [crop, ActionCommand('erase_by_mask', params)]
+                if not moved:
+                    # Giữ lại kiểm tra kích thước mask == ảnh tại vị trí gốc của mask (trước crop),
+                    # sau khi đổi chỗ erase_by_mask chỉ còn thấy vùng đã crop
+                    replacement.insert(0, ActionCommand('check_mask_size', params['mask_path']))
+                steps[i:i + 2] = replacement
+                changed = True
+                break
+        return steps
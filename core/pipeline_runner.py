@@ -2,30 +2,60 @@ import json
 import numpy as np
 from PIL import Image
 import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 
 from .base_processor import ImageProcessor
 
 from .pipeline_builder import PartialPipeline
 
-def run_multi_pipeline(asset_dir: str, input_path: str, ProcessorClass: ImageProcessor, output_dir: str = '', debug: bool = False) -> Image.Image:
+@lru_cache(maxsize=32)
+def load_partials(asset_dir: str) -> tuple:
+    # Cache theo asset_dir: các row cùng type/size dùng lại config đã parse
     config_path = os.path.join(asset_dir, "config.json")
+    with open(config_path) as f:
+        config = json.load(f)
+    return tuple(config.get("partials", []))
+
+@lru_cache(maxsize=32)
+def load_pipelines(asset_dir: str, ProcessorClass: type) -> tuple:
+    # Dựng và bind pipeline một lần theo (asset_dir, ProcessorClass), các row sau dùng lại
+    return tuple(PartialPipeline.from_json(partial_json, asset_dir, ProcessorClass) for partial_json in load_partials(asset_dir))
+
+def partial_cost(partial_json: dict) -> int:
+    # Ước lượng khối lượng xử lý theo diện tích crop/resize lớn nhất trong steps
+    cost = 0
+    for step in partial_json.get("steps", []):
+        data = step.get("data")
+        if step.get("action") in ("crop", "resize") and isinstance(data, dict):
+            cost = max(cost, data.get("width", 0) * data.get("height", 0))
+    return cost
+
+def process_partial(base: ImageProcessor, pipeline: PartialPipeline, output_dir: str = '', debug: bool = False):
+    print(f"Processing partial: {pipeline.id}")
+    proc = base.clone()
+    for idx, step in enumerate(pipeline.steps):
+        print(f"Processing step: {step.action_type}")
+        step.execute(proc)
+        if debug:
+            proc.save(os.path.join(output_dir, f"debug_{pipeline.id}_{idx}_{step.action_type}.png"), preview=False)
+    return proc, pipeline.location
+
+def run_multi_pipeline(asset_dir: str, input_path: str, ProcessorClass: ImageProcessor, output_dir: str = '', debug: bool = False, max_workers: int = None) -> Image.Image:
     layout_path = os.path.join(asset_dir, 'layout.png')
-    config = json.load(open(config_path))
-    partials_json = config.get("partials", [])
+    partials_json = load_partials(asset_dir)
+    pipelines = load_pipelines(asset_dir, ProcessorClass)
     base = ProcessorClass.load(input_path)
 
     canvas, layout = base.load_layout(layout_path)
-    partial_processors = []
-    for partial_json in partials_json:
-        print(f"Processing partial: {partial_json.get('id')}")
-        pipeline = PartialPipeline.from_json(partial_json, asset_dir)
-        proc = base.clone()
-        for idx, step in enumerate(pipeline.steps):
-            print(f"Processing step: {step.action_type}")
-            step.execute(proc)
-            if debug:
-                proc.save(os.path.join(output_dir, f"debug_{partial_json.get('id')}_{idx}_{step.action_type}.png"), preview=False)
-        partial_processors.append((proc, pipeline.location))
+
+    # Các partial độc lập nhau (chỉ đọc base) -> xử lý song song.
+    # Submit partial lớn trước để không bị kẹt một partial lớn ở cuối, composite vẫn theo thứ tự config
+    with ThreadPoolExecutor(max_workers=max_workers or os.cpu_count()) as executor:
+        futures = [None] * len(partials_json)
+        for idx in sorted(range(len(partials_json)), key=lambda i: partial_cost(partials_json[i]), reverse=True):
+            futures[idx] = executor.submit(process_partial, base, pipelines[idx], output_dir, debug)
+        partial_processors = [future.result() for future in futures]
 
     for proc, loc in partial_processors:
         canvas.composite(proc, loc["left"], loc["top"])
@@ -1,11 +1,21 @@
 import os
 import csv
+from itertools import groupby
+from multiprocessing import get_context
+
+import psutil
+from wand.resource import limits
 
 from processor import OpenCVProcessor, WandProcessor
 from core import run_multi_pipeline
 
 from monitor import wrapper_monitor
 
+# Ước lượng RAM đỉnh của một worker Wand với artwork ~12k x 6k (ảnh gốc + clone từng partial + canvas)
+WORKER_MEMORY_GB = 4
+# Số row một worker xử lý trước khi bị thay mới (giới hạn bộ nhớ ImageMagick/Wand tăng dần)
+ROWS_PER_WORKER = 4
+
 def read_csv(file_path):
     arr = []
     with open(file_path, mode='r', newline='', encoding='utf-8') as file:
@@ -14,6 +24,58 @@ def read_csv(file_path):
             arr.append(row)
     return arr
 
+def process_row(row, dir_path, output_dir):
+    item = row['item']
+    print(f'Processing item: {item}')
+    file_path = os.path.join(dir_path, f'{item}_front.png')
+    type = row['type'].upper()
+    size = row['size'].upper()
+    asset_dir = os.path.join('assets', type, size)
+    
+    # print(f'OpenCVProcessor processing for item: {item}')
+    # output_opencv_path = os.path.join(output_dir, f'{item}_opencv.tif')
+    # canvas_opencv = run_multi_pipeline(asset_dir, file_path, OpenCVProcessor, max_workers=1)
+    # canvas_opencv.save(output_opencv_path, preview=False)
+    
+    print(f'WandProcessor processing for item: {item}')
+    output_wand_path = os.path.join(output_dir, f'{item}_wand.tif')
+    # Đã song song theo row nên các partial trong một row chạy tuần tự
+    canvas_wand = run_multi_pipeline(asset_dir, file_path, WandProcessor, max_workers=1)
+    canvas_wand.save(output_wand_path, preview=False)
+    print (f'Finished processing item: {item}')
+
+def asset_key(row):
+    return row['type'].upper(), row['size'].upper()
+
+def process_row_batch(rows, dir_path, output_dir):
+    # Các row trong một batch cùng asset_dir: config/layout đã cache trong worker được dùng lại
+    for row in rows:
+        process_row(row, dir_path, output_dir)
+
+def _init_worker():
+    # Song song đã theo process: mỗi worker chỉ dùng 1 thread OpenMP của ImageMagick,
+    # không thì N worker x N thread
+    limits['thread'] = 1
+
+def default_processes():
+    # Không vượt số core và số worker mà RAM còn trống chứa được
+    available_gb = psutil.virtual_memory().available / (1024**3)
+    return max(1, min(os.cpu_count() or 1, int(available_gb // WORKER_MEMORY_GB)))
+
+def process_rows(data, dir_path, output_dir, processes=None):
+    # Mỗi row độc lập (asset_dir, input, output riêng) -> chạy song song bằng process pool.
+    # Mỗi task là một batch tối đa ROWS_PER_WORKER row cùng asset_dir, maxtasksperchild=1 nên
+    # worker được thay mới sau đúng một batch (chunksize=1: starmap không gom nhiều task lại)
+    batches = []
+    for _, group in groupby(sorted(data, key=asset_key), key=asset_key):
+        group = list(group)
+        for i in range(0, len(group), ROWS_PER_WORKER):
+            batches.append((group[i:i + ROWS_PER_WORKER], dir_path, output_dir))
+    # forkserver: wrapper_monitor đang chạy thread, fork thẳng từ process này dễ thừa hưởng lock đang giữ
+    ctx = get_context('forkserver')
+    with ctx.Pool(processes=processes or default_processes(), initializer=_init_worker, maxtasksperchild=1) as pool:
+        pool.starmap(process_row_batch, batches, chunksize=1)
+
 @wrapper_monitor()
 def main(debug: bool = False):
     asset_dir = 'L'
@@ -30,24 +92,7 @@ def main(debug: bool = False):
     return
     dir_path = os.path.join('.downloads')
     data = read_csv('temp.csv')
-    for row in data:
-        item = row['item']
-        print(f'Processing item: {item}')
-        file_path = os.path.join(dir_path, f'{item}_front.png')
-        type = row['type'].upper()
-        size = row['size'].upper()
-        asset_dir = os.path.join('assets', type, size)
-        
-        # print(f'OpenCVProcessor processing for item: {item}')
-        # output_opencv_path = os.path.join(output_dir, f'{item}_opencv.tif')
-        # canvas_opencv = run_multi_pipeline(asset_dir, file_path, OpenCVProcessor)
-        # canvas_opencv.save(output_opencv_path, preview=False)
-        
-        print(f'WandProcessor processing for item: {item}')
-        output_wand_path = os.path.join(output_dir, f'{item}_wand.tif')
-        canvas_wand = run_multi_pipeline(asset_dir, file_path, WandProcessor)
-        canvas_wand.save(output_wand_path, preview=False)
-        print (f'Finished processing item: {item}')
+    process_rows(data, dir_path, output_dir)
 
 if __name__ == "__main__":
     main(debug=False)
\ No newline at end of file
@@ -1,21 +1,21 @@
-from multiprocessing import Process, Event
+from threading import Thread, Event
 import time
 import psutil
 from datetime import datetime
 
 def monitor_cpu_mem(stop_event, func_name, poll_interval=0.05, log_file=None):
-    import psutil, time
-    from datetime import datetime
-
     cpu_data_percent = []
     mem_data_percent = []
     start = datetime.now()
 
     total_mem_gb = psutil.virtual_memory().total / (1024**3)
 
+    # Lần gọi đầu chỉ để khởi tạo mốc, các lần sau không block (interval=None)
+    psutil.cpu_percent(interval=None)
+
     try:
-        while not stop_event.is_set():
-            cpu_percent = psutil.cpu_percent(interval=poll_interval)
+        while not stop_event.wait(poll_interval):
+            cpu_percent = psutil.cpu_percent(interval=None)
             mem_info = psutil.virtual_memory()
             mem_percent = mem_info.percent
 
@@ -54,16 +54,17 @@ def wrapper_monitor(only_time=False, log_file=None):
     def decorator(func):
         def wrapper(*args, **kwargs):
             stop_event = Event()
-            monitor_proc = None
+            monitor_thread = None
 
             if not only_time:
-                monitor_proc = Process(
+                # Thread trong cùng process: không fork/spawn process con chỉ để lấy mẫu psutil
+                monitor_thread = Thread(
                     target=monitor_cpu_mem,
                     args=(stop_event, func.__name__),
                     kwargs={"poll_interval": 0.1, "log_file": log_file},
                     daemon=True,
                 )
-                monitor_proc.start()
+                monitor_thread.start()
 
             start = datetime.now()
             result = func(*args, **kwargs)
@@ -71,9 +72,7 @@ def wrapper_monitor(only_time=False, log_file=None):
 
             if not only_time:
                 stop_event.set()
-                monitor_proc.join(timeout=2)
-                if monitor_proc.is_alive():
-                    monitor_proc.terminate()
+                monitor_thread.join(timeout=2)
             else:
                 duration = (end - start).total_seconds() / 60
                 print(f"Function '{func.__name__}' executed in {duration:.2f} phút")
@@ -2,22 +2,123 @@ import cv2
 import numpy as np
 from PIL import Image
 import os
-from wand.image import Image as WandImage
-from wand.color import Color
+from functools import lru_cache
+import tifffile
 
 from core import ImageProcessor
 
 ALLOWED_MODES = ['CMYK', 'RGBA', 'RGB']
 
+# Mức nén deflate khi save: 1 nhanh hơn mặc định (6) ~40%, file lớn hơn ~8%
+ZLIB_LEVEL = 1
+
+# Song song đã có ở ngoài (Pool theo row, thread pool theo partial): tắt thread pool nội bộ
+# của OpenCV để không oversubscribe CPU
+cv2.setNumThreads(1)
+
+# Dùng GPU cho resize/warpAffine chỉ khi bật ICC_WORKER_CUDA=1 (chưa kiểm chứng kết quả so với CPU),
+# OpenCV được build với CUDA và có device
+USE_CUDA = (
+    os.environ.get('ICC_WORKER_CUDA') == '1'
+    and hasattr(cv2, 'cuda')
+    and cv2.cuda.getCudaEnabledDeviceCount() > 0
+)
+# Không có CUDA thì dùng OpenCL (T-API) qua cv2.UMat, chỉ khi bật ICC_WORKER_OPENCL=1:
+# kernel OpenCL không bit-exact với CPU và mỗi lần gọi phải upload/download
+USE_OPENCL = (
+    not USE_CUDA
+    and os.environ.get('ICC_WORKER_OPENCL') == '1'
+    and cv2.ocl.haveOpenCL()
+    and cv2.ocl.useOpenCL()
+)
+
+
+def _to_gpu(src):
+    gpu = cv2.cuda_GpuMat()
+    gpu.upload(np.ascontiguousarray(src))
+    return gpu
+
+
+def _resize(src, size, interpolation):
+    if USE_CUDA:
+        return cv2.cuda.resize(_to_gpu(src), size, interpolation=interpolation).download()
+    if USE_OPENCL:
+        return cv2.resize(cv2.UMat(np.ascontiguousarray(src)), size, interpolation=interpolation).get()
+    return cv2.resize(src, size, interpolation=interpolation)
+
+
+def _warp_affine(src, M, size, flags, border_value):
+    if USE_CUDA:
+        return cv2.cuda.warpAffine(
+            _to_gpu(src), M, size, flags=flags, borderMode=cv2.BORDER_CONSTANT, borderValue=border_value
+        ).download()
+    if USE_OPENCL:
+        return cv2.warpAffine(
+            cv2.UMat(np.ascontiguousarray(src)), M, size, flags=flags, borderMode=cv2.BORDER_CONSTANT, borderValue=border_value
+        ).get()
+    return cv2.warpAffine(src, M, size, flags=flags, borderMode=cv2.BORDER_CONSTANT, borderValue=border_value)
+
+
+# Không cache: mỗi config dùng mỗi mask một lần (tới 17 mask ~70 MB/mask), cache chỉ giữ RAM mà không trúng
+def _load_mask_alpha(mask_path):
+    with Image.open(mask_path) as mask:
+        # Chỉ lấy band alpha, không dựng cả ảnh RGBA (H, W, 4)
+        if mask.mode not in ('RGBA', 'LA', 'PA'):
+            mask = mask.convert("RGBA")
+        return np.asarray(mask.getchannel('A'))
+
+
+# Cache layout đã decode theo (path, mode): các row cùng asset_dir không phải decode lại PNG
+@lru_cache(maxsize=4)
+def _load_layout(path, mode):
+    with Image.open(path) as im:
+        input_image = im.convert("RGBA")
+    if mode == 'CMYKA':
+        cmyk = input_image.convert("CMYK")
+        np_cmyk = np.asarray(cmyk)  # (H, W, 4)
+        # Cấp phát sẵn (H, W, 5) rồi điền từng phần, không qua np.dstack + astype
+        h, w = np_cmyk.shape[:2]
+        np_layout = np.empty((h, w, 5), dtype=np.uint8)
+        np_layout[:, :, :4] = np_cmyk
+        # Chỉ lấy band alpha từ ảnh RGBA đã decode, không chuyển cả (H, W, 4) sang numpy lần nữa
+        np_layout[:, :, 4] = np.asarray(input_image.getchannel('A'))
+    else:
+        np_layout = np.asarray(input_image)  # (H, W, 4)
+    np_layout.setflags(write=False)
+    return np_layout
+
+
+# Cache ma trận xoay theo (h, w, angle): các partial cùng kích thước/góc không tính lại
+@lru_cache(maxsize=64)
+def _rotation_matrix(h, w, angle):
+    # Tâm xoay
+    center = (w / 2, h / 2)
+    M = cv2.getRotationMatrix2D(center, -angle, 1.0)
+
+    # Tính kích thước canvas mới
+    cos = abs(M[0, 0])
+    sin = abs(M[0, 1])
+    new_w = int((h * sin) + (w * cos))
+    new_h = int((h * cos) + (w * sin))
+
+    # Dịch chuyển để giữ tâm ở giữa canvas mới
+    M[0, 2] += (new_w / 2) - center[0]
+    M[1, 2] += (new_h / 2) - center[1]
+    M.setflags(write=False)
+    return M, new_w, new_h
+
+
 class OpenCVProcessor(ImageProcessor):
     image = None
     icc_profile = None
     mode = None
     
-    def __init__(self, image, icc_profile, mode):
+    def __init__(self, image, icc_profile, mode, shared=False):
         self.image = image
         self.icc_profile = icc_profile
         self.mode = mode
+        # True khi self.image còn dùng chung buffer với processor khác (copy-on-write)
+        self.shared = shared
 
     @classmethod
     def load(cls, path):
@@ -30,40 +131,84 @@ class OpenCVProcessor(ImageProcessor):
         if ALLOWED_MODES and mode not in ALLOWED_MODES:
             raise ValueError(f"Unsupported image mode: {mode}. Allowed modes: {ALLOWED_MODES}")
 
-        np_img = np.array(im)
-        if mode == 'CMYK':
-            alpha = np.full((np_img.shape[0], np_img.shape[1], 1), 255, dtype=np.uint8)
-            np_img = np.concatenate([np_img, alpha], axis=2)
-            mode = 'CMYKA'
-        elif mode == 'RGB':
-            alpha = np.full((np_img.shape[0], np_img.shape[1], 1), 255, dtype=np.uint8)
-            np_img = np.concatenate([np_img, alpha], axis=2)
-            mode = 'RGBA'
+        shared = False
+        if mode in ('CMYK', 'RGB'):
+            # Cấp phát sẵn buffer (H, W, C + 1) rồi điền alpha, không qua np.full + np.concatenate
+            src = np.asarray(im)
+            h, w, c = src.shape
+            np_img = np.empty((h, w, c + 1), dtype=np.uint8)
+            np_img[:, :, :c] = src
+            np_img[:, :, c].fill(255)
+            mode = 'CMYKA' if mode == 'CMYK' else 'RGBA'
         elif mode == 'RGBA':
-            pass  # already has alpha channel
+            # already has alpha channel: giữ view read-only, copy-on-write khi có thao tác ghi
+            np_img = np.asarray(im)
+            shared = True
 
-        return cls(np_img, icc_profile, mode)
+        return cls(np_img, icc_profile, mode, shared=shared)
 
     def clone(self):
-        return OpenCVProcessor(self.image.copy(), self.icc_profile, self.mode)
-
-    def erase_by_mask(self, mask_path):
-        mask_alpha = np.array(Image.open(mask_path).convert("RGBA"))[:, :, 3]
-
-        alpha = self.clone().image[:, :, -1].astype(np.int16)
-        mask_alpha = mask_alpha.astype(np.int16)
-
-        new_alpha = np.clip(alpha - mask_alpha, 0, 255).astype(np.uint8)
-
+        # Không copy ngay: hai bên dùng chung buffer, chỉ copy khi có thao tác ghi tại chỗ
+        self.shared = True
+        return OpenCVProcessor(self.image, self.icc_profile, self.mode, shared=True)
+
+    def _ensure_writable(self):
+        if self.shared:
+            self.image = self.image.copy()
+            self.shared = False
+
+    def erase_by_mask(self, mask_path, left=0, top=0):
+        # Ảnh có thể đã được crop trước (PartialPipeline.crop_before_mask): lấy đúng vùng mask tương ứng
+        h, w = self.image.shape[:2]
+        mask_alpha = _load_mask_alpha(mask_path)[top:top + h, left:left + w]
+        if mask_alpha.shape != (h, w):
+            raise ValueError(f"Mask {mask_path} không khớp vùng ảnh: {mask_alpha.shape} != {(h, w)}")
+
+        # Mask không xoá gì trong vùng này / xoá toàn bộ: không cần trừ từng pixel
+        if mask_alpha.max() == 0:
+            return self
+        if mask_alpha.min() == 255:
+            self._ensure_writable()
+            self.image[:, :, -1] = 0
+            return self
+
+        # Trừ bão hoà trên uint8 (cv2.subtract), không promote int16 + clip
+        alpha = np.ascontiguousarray(self.image[:, :, -1])
+        new_alpha = cv2.subtract(alpha, mask_alpha)
+
+        self._ensure_writable()
         self.image[:, :, -1] = new_alpha
 
         return self
     
+    def check_mask_size(self, mask_path):
+        # Chỉ đọc header PNG để lấy kích thước, không decode mask
+        with Image.open(mask_path) as mask:
+            mask_size = mask.size
+        h, w = self.image.shape[:2]
+        if mask_size != (w, h):
+            raise ValueError(f"Mask {mask_path} không khớp kích thước ảnh: {mask_size} != {(w, h)}")
+        return self
+
     def resize(self, width, height):
-        channels, alpha = self.image[:, :, :-1], self.image[:, :, -1]
-        channels_resized = cv2.resize(channels, (width, height), interpolation=cv2.INTER_LANCZOS4)
-        alpha_resized = cv2.resize(alpha, (width, height), interpolation=cv2.INTER_NEAREST)
-        self.image = np.dstack((channels_resized, alpha_resized))
+        h, w = self.image.shape[:2]
+        # Đúng kích thước sẵn: không nội suy, không cấp phát ảnh mới
+        if (width, height) == (w, h):
+            return self
+
+        # Thu nhỏ dùng INTER_AREA, phóng to dùng INTER_LINEAR (nhanh hơn LANCZOS4 nhiều)
+        interpolation = cv2.INTER_AREA if width <= w and height <= h else cv2.INTER_LINEAR
+
+        # Alpha nội suy cùng kiểu với màu (giống Wand); <= 4 kênh resize một lần, CMYKA tách 4 + 1
+        image = self.image
+        if image.shape[2] <= 4:
+            self.image = _resize(image, (width, height), interpolation)
+        else:
+            self.image = np.dstack((
+                _resize(np.ascontiguousarray(image[:, :, :4]), (width, height), interpolation),
+                _resize(np.ascontiguousarray(image[:, :, 4]), (width, height), interpolation),
+            ))
+        self.shared = False
 
         return self
 
@@ -78,111 +223,105 @@ class OpenCVProcessor(ImageProcessor):
         (h, w) = image.shape[:2]
         num_channels = image.shape[2]
 
-        # Tâm xoay
-        center = (w / 2, h / 2)
-        M = cv2.getRotationMatrix2D(center, -angle, 1.0)
-
-        # Tính kích thước canvas mới
-        cos = abs(M[0, 0])
-        sin = abs(M[0, 1])
-        new_w = int((h * sin) + (w * cos))
-        new_h = int((h * cos) + (w * sin))
-
-        # Dịch chuyển để giữ tâm ở giữa canvas mới
-        M[0, 2] += (new_w / 2) - center[0]
-        M[1, 2] += (new_h / 2) - center[1]
-
-        # Tách kênh và xoay từng phần
-        rotated_channels = []
-        for i in range(num_channels):
-            ch = image[..., i]
-            rotated = cv2.warpAffine(
-                ch,
-                M,
-                (new_w, new_h),
-                flags=cv2.INTER_LINEAR,
-                borderMode=cv2.BORDER_CONSTANT,
-                borderValue=0,  # trong suốt ở alpha
-            )
-            rotated_channels.append(rotated)
-
-        # Ghép lại
-        rotated = cv2.merge(rotated_channels)
-        self.image = rotated
+        angle = angle % 360
+        if angle == 0:
+            return self
+
+        if angle % 90 == 0:
+            # Góc vuông: cv2.rotate (transpose/flip), không cần nội suy
+            code = {90: cv2.ROTATE_90_CLOCKWISE, 180: cv2.ROTATE_180, 270: cv2.ROTATE_90_COUNTERCLOCKWISE}[angle]
+
+            def transform(src):
+                return cv2.rotate(src, code)
+        else:
+            M, new_w, new_h = _rotation_matrix(h, w, angle)
+
+            def transform(src):
+                return _warp_affine(src, M, (new_w, new_h), flags=cv2.INTER_LINEAR, border_value=0)  # trong suốt ở alpha
+
+        # OpenCV chỉ có fast path SIMD cho tối đa 4 kênh -> CMYKA tách thành 4 + 1
+        if num_channels <= 4:
+            self.image = transform(image)
+        else:
+            self.image = np.dstack((transform(image[..., :4]), transform(image[..., 4:])))
+        self.shared = False
+
+        return self
 
     def crop(self, left=0, top=0, width=0, height=0, auto=False):
         x1, y1, x2, y2 = left, top, left + width, top + height
         if auto:
-            alpha = self.image[:, :, -1]
-            ys, xs = np.where(alpha > 0)
-            top, bottom = ys.min(), ys.max()
-            left, right = xs.min(), xs.max()
-            self.image = self.image[top:bottom + 1, left:right + 1]
+            # Bounding box của vùng có alpha bằng cv2.boundingRect, không dựng mảng toạ độ như np.where
+            alpha_mask = self.image[:, :, -1] > 0
+            left, top, width, height = cv2.boundingRect(alpha_mask.view(np.uint8))
+            if width and height:
+                self.image = self.image[top:top + height, left:left + width]
         else:
             self.image = self.image[y1:y2, x1:x2]
 
         return self
 
     def composite(self, other: 'OpenCVProcessor', x, y):
-        h, w, _ = other.image.shape
-
-        target_region = self.image[y:y+h, x:x+w, :]
-
         alpha_mask = other.image[:, :, -1] > 0
-        alpha_mask = alpha_mask[:, :, None]
-
-        target_region = np.where(alpha_mask, other.image, target_region)
-
-        self.image[y:y+h, x:x+w, :] = target_region
-
-        return self
-
-    def save(self, path, preview=False):
-        channels, alpha = self.image[:, :, :-1], self.image[:, :, -1]
-        h, w, _ = self.image.shape
 
-        channels_bytes = channels.tobytes()
-        alpha_bytes = alpha.tobytes()
-        if self.mode == 'CMYKA':
-            channel_map = 'cmyk'
-            colorspace = 'cmyk'
+        # Chỉ xử lý bounding box của vùng có alpha, bỏ qua viền trong suốt
+        bx, by, w, h = cv2.boundingRect(alpha_mask.view(np.uint8))
+        if w == 0 or h == 0:
+            return self
+
+        # Ghi thẳng vào vùng canvas, không tạo mảng tạm như np.where
+        self._ensure_writable()
+        source = other.image[by:by+h, bx:bx+w, :]
+        target_region = self.image[y+by:y+by+h, x+bx:x+bx+w, :]
+        alpha_mask = alpha_mask[by:by+h, bx:bx+w]
+
+        # Piece vượt mép canvas: cắt source/mask theo vùng canvas thực có,
+        # nếu không cv2.copyTo sẽ cấp phát dst mới và piece bị bỏ mất
+        th, tw = target_region.shape[:2]
+        if th == 0 or tw == 0:
+            return self
+        source = source[:th, :tw]
+        alpha_mask = alpha_mask[:th, :tw]
+
+        if alpha_mask.all():
+            # Bounding box phủ kín: copy nguyên khối, không cần mask từng pixel
+            target_region[...] = source
         else:
-            channel_map = 'rgb'
-            colorspace = 'rgb'
-
-        with WandImage(width=w, height=h, depth=8, background=Color('transparent')) as img:
-            img.format = 'tiff'
-            img.colorspace = colorspace
-            img.alpha_channel = 'activate'
-            img.units = 'pixelsperinch'
-            img.resolution = (100, 100)
-
-            # write CMYK channels
-            img.import_pixels(channel_map=channel_map, data=channels_bytes)
+            # cv2.copyTo ghi tại chỗ vào view của canvas (masked copy SIMD của OpenCV)
+            cv2.copyTo(source, alpha_mask.view(np.uint8), target_region)
 
-            # write alpha
-            img.import_pixels(channel_map='a', data=alpha_bytes)
+        return self
 
-            img.profiles['icc'] = self.icc_profile
+    def save(self, path, preview=False, compression='zlib'):
+        """
+        compression: 'zlib' (Adobe Deflate, mặc định), 'lzw' hoặc None (không nén)
+        """
+        photometric = 'separated' if self.mode == 'CMYKA' else 'rgb'
+
+        # Ghi thẳng mảng (H, W, C) bằng tifffile, không qua Wand import_pixels
+        tifffile.imwrite(
+            path,
+            self.image,
+            photometric=photometric,
+            planarconfig='contig',
+            extrasamples=['unassalpha'],
+            compression=compression,
+            compressionargs={'level': ZLIB_LEVEL} if compression == 'zlib' else None,
+            # Ghi theo tile để tifffile nén song song các tile
+            tile=(512, 512),
+            maxworkers=os.cpu_count(),
+            resolution=(100, 100),
+            resolutionunit='INCH',
+            iccprofile=self.icc_profile,
+            metadata=None,
+        )
 
-            img.compression = 'zip'
-            # save file
-            img.save(filename=path)
-         
     def load_layout(self, path):
-        input_image = Image.open(path).convert("RGBA")
-        if self.mode == 'CMYKA':
-            cmyk = input_image.convert("CMYK")
-            np_cmyk = np.array(cmyk)  # (H, W, 4)
-            alpha = np.array(input_image)[:, :, 3][:, :, None]  # (H,W,1)
-            np_layout = np.dstack([np_cmyk, alpha]).astype(np.uint8)  # (H,W,5)
-            h, w = np_layout.shape[:2]
-            np_canvas = np.zeros((h, w, 5), dtype=np.uint8)
-        else:
-            np_layout = np.array(input_image)  # (H, W, 4)
-            h, w = np_layout.shape[:2]
-            np_canvas = np.zeros((h, w, 4), dtype=np.uint8)
+        np_layout = _load_layout(path, self.mode)
+        h, w, c = np_layout.shape
+        np_canvas = np.zeros((h, w, c), dtype=np.uint8)
 
         canvas_proc = OpenCVProcessor(np_canvas, self.icc_profile, self.mode)
-        layout_proc = OpenCVProcessor(np_layout, self.icc_profile, self.mode)
-        return canvas_proc, layout_proc
\ No newline at end of file
+        # Layout lấy từ cache: dùng chung, copy-on-write nếu có thao tác ghi
+        layout_proc = OpenCVProcessor(np_layout, self.icc_profile, self.mode, shared=True)
+        return canvas_proc, layout_proc
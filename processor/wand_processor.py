@@ -1,11 +1,35 @@
 from wand.image import Image
 from wand.color import Color
 import numpy as np
+from functools import lru_cache
 
 from core import ImageProcessor
 
 ALLOWED_MODES = ['CMYK', 'RGBA', 'RGB']
 
+# Tên compression chung với OpenCVProcessor.save -> tên của ImageMagick
+COMPRESSION_TYPES = {'zlib': 'zip', 'lzw': 'lzw', None: 'no'}
+
+
+# Không cache: mỗi config dùng mỗi mask một lần (tới 17 mask ~70 MB/mask), cache chỉ giữ RAM mà không trúng
+def _load_mask_alpha(mask_path):
+    with Image(filename=mask_path) as mask:
+        if 'alpha' not in mask.channel_images:
+            mask.alpha_channel = True
+        # channel_images tạo image ImageMagick mới: copy ra numpy (2-D) rồi đóng ngay
+        with mask.channel_images['alpha'] as alpha:
+            return np.array(alpha)[:, :, 0]
+
+
+# Cache layout đã decode theo (path, color_space): các row cùng asset_dir không phải decode lại PNG
+@lru_cache(maxsize=4)
+def _load_layout(path, color_space):
+    layout = Image(filename=path)
+    layout.transform_colorspace(color_space)
+    layout.alpha_channel = True
+    return layout
+
+
 class WandProcessor(ImageProcessor):
     image = None
     icc_profile = None
@@ -19,11 +43,12 @@ class WandProcessor(ImageProcessor):
     @classmethod
     def load(cls, path):
         img = Image(filename=path)
-        img.alpha_channel = 'activate'
-        alpha_np = np.array(img.channel_images['alpha'])
-        if alpha_np.max() == 0 and alpha_np.min() == 0:
-            full_opaque = Image.from_array(np.full_like(alpha_np, 255, dtype=np.uint8))
-            img.composite_channel('alpha', full_opaque, 'copy_alpha')
+        # Ảnh không có alpha (hoặc alpha toàn 0): set alpha đục ngay trong ImageMagick,
+        # không dựng mảng 255 bằng numpy rồi composite ngược lại
+        if not img.alpha_channel:
+            img.alpha_channel = 'opaque'
+        elif np.asarray(img.channel_images['alpha']).max() == 0:
+            img.alpha_channel = 'opaque'
         
         if img.colorspace.lower() not in ['cmyk', 'srgb']:
             raise ValueError(f"Ảnh input không phải CMYK (colorspace={img.colorspace})!")
@@ -33,15 +58,24 @@ class WandProcessor(ImageProcessor):
     def clone(self):
         return WandProcessor(self.image.clone(), self.icc_profile, self.color_space)
 
-    def erase_by_mask(self, mask_path):
-        base_clone = self.clone()
-        mask = Image(filename=mask_path)
-        if 'alpha' not in mask.channel_images:
-            mask.alpha_channel = True
-        base_alpha = np.array(base_clone.image.channel_images['alpha'], dtype=np.int16)
-        mask_alpha = np.array(mask.channel_images['alpha'], dtype=np.int16)
+    def erase_by_mask(self, mask_path, left=0, top=0):
+        # Ảnh có thể đã được crop trước (PartialPipeline.crop_before_mask): lấy đúng vùng mask tương ứng
+        h, w = self.image.height, self.image.width
+        mask_alpha = _load_mask_alpha(mask_path)[top:top + h, left:left + w]
+        if mask_alpha.shape != (h, w):
+            raise ValueError(f"Mask {mask_path} không khớp vùng ảnh: {mask_alpha.shape} != {(h, w)}")
+
+        # Mask không xoá gì trong vùng này: bỏ qua, không export/import alpha
+        if mask_alpha.max() == 0:
+            return self
 
-        new_alpha = np.clip(base_alpha - mask_alpha, 0, 255).astype(np.uint8)
+        if mask_alpha.min() == 255:
+            new_alpha = np.zeros((h, w), dtype=np.uint8)
+        else:
+            # Trừ bão hoà ngay trên uint8: base - min(base, mask), không promote int16 + clip
+            with self.image.channel_images['alpha'] as alpha:
+                base_alpha = np.array(alpha, dtype=np.uint8)[:, :, 0]
+            new_alpha = base_alpha - np.minimum(base_alpha, mask_alpha)
         img_alpha = Image.from_array(new_alpha)
         img_alpha.type = 'grayscale'
         img_alpha.colorspace = 'gray'
@@ -50,8 +84,18 @@ class WandProcessor(ImageProcessor):
 
         return self
     
+    def check_mask_size(self, mask_path):
+        # ping chỉ đọc header để lấy kích thước, không decode mask
+        with Image.ping(filename=mask_path) as mask:
+            mask_size = mask.size
+        if mask_size != self.image.size:
+            raise ValueError(f"Mask {mask_path} không khớp kích thước ảnh: {mask_size} != {self.image.size}")
+        return self
+
     def resize(self, width, height):
-        self.image.resize(width, height)
+        # Đúng kích thước sẵn: không để ImageMagick resample lại
+        if (width, height) != self.image.size:
+            self.image.resize(width, height)
         return self
     
     def rotate(self, angle):
@@ -69,17 +113,19 @@ class WandProcessor(ImageProcessor):
         self.image.composite(other.image, left=x, top=y)
         return self
 
-    def save(self, path, preview=False):
+    def save(self, path, preview=False, compression='zlib'):
+        """
+        compression: 'zlib' (Adobe Deflate, mặc định), 'lzw' hoặc None (không nén)
+        """
         self.image.profiles['icc'] = self.icc_profile
         self.image.units = 'pixelsperinch'
         self.image.resolution = (100, 100)
-        self.image.compression = 'zip'
+        self.image.compression = COMPRESSION_TYPES[compression]
         self.image.save(filename=path)
         
     def load_layout(self, path):
-        layout = Image(filename=path)
-        layout.transform_colorspace(self.color_space)
-        layout.alpha_channel = True
+        # Clone từ layout đã cache (ImageMagick chia sẻ pixel cache tới khi có thao tác ghi)
+        layout = _load_layout(path, self.color_space).clone()
 
         canvas = Image(width=layout.width, height=layout.height, background=Color("transparent"))
         canvas.colorspace = self.color_space
@@ -87,4 +133,4 @@ class WandProcessor(ImageProcessor):
         canvas_proc = WandProcessor(canvas, self.icc_profile, self.color_space)
         layout_proc = WandProcessor(layout, self.icc_profile, self.color_space)
         
-        return canvas_proc, layout_proc
\ No newline at end of file
+        return canvas_proc, layout_proc